@@ -48,6 +48,9 @@ def swish(x):
 
 ACT2FN = {"gelu": torch.nn.functional.gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
+# scaled_dot_product_attention is only available on PyTorch >= 2.0
+HAS_SDPA = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
 
 class Attention(nn.Module):
     def __init__(self, config, vis):
@@ -81,13 +84,21 @@ class Attention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        attention_probs = self.softmax(attention_scores)
-        weights = attention_probs if self.vis else None
-        attention_probs = self.attn_dropout(attention_probs)
+        if self.vis or not HAS_SDPA:
+            # The fused kernel does not expose the attention map needed for visualization
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            attention_probs = self.softmax(attention_scores)
+            weights = attention_probs
+            attention_probs = self.attn_dropout(attention_probs)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+            context_layer = torch.matmul(attention_probs, value_layer)
+        else:
+            weights = None
+            context_layer = torch.nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                dropout_p=self.attn_dropout.p if self.training else 0.0,
+                is_causal=False)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -1,28 +1,34 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+import inspect
 import logging
 import argparse
 import os
 import random
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import torch
 import torch.distributed as dist
+import torch.nn.functional as F
 from torch.utils.data import dataset
 
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
-from apex import amp
-from apex.parallel import DistributedDataParallel as DDP
+from torch.nn.parallel import DistributedDataParallel as TorchDDP
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+except ImportError:
+    sdpa_kernel = None
 import torchnet as tnt
 
 from models.modeling import VisionTransformer, CONFIGS
 from utils.scheduler import WarmupLinearSchedule, WarmupCosineSchedule
 from utils.data_utils import get_loader
-from utils.dist_util import get_world_size
 
 
 logger = logging.getLogger(__name__)
@@ -47,7 +53,7 @@ class AverageMeter(object):
 
 
 def simple_accuracy(preds, labels):
-    return (preds == labels).mean()
+    return (preds == labels).float().mean().item()
 
 
 def save_model(args, model):
@@ -61,13 +67,34 @@ def save_model_complete(args, model, optimizer, accuracy = None, step = 0):
         checkpoint_file = os.path.join(args.output_dir_every_checkpoint, "step_{}_checkpoint.pth".format(step))
     else:
         checkpoint_file = os.path.join(args.output_dir, "best_acc_step_{}_acc_{}_checkpoint.pth".format(step, accuracy))
-    torch.save({
+    # Snapshot to CPU here so training can keep updating the live tensors
+    state = {
         'step': step,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
+        'model_state_dict': _to_cpu(model.state_dict()),
+        'optimizer_state_dict': _to_cpu(optimizer.state_dict()),
         'best_accuracy': accuracy,
-    }, checkpoint_file)
-    logger.info("Saved model checkpoint to [DIR: %s]", args.output_dir)
+    }
+    # Serialize in the background into a temp file, then rename it into place
+    tmp_file = checkpoint_file + ".tmp"
+
+    def _finalize(future):
+        if future.exception() is not None:
+            logger.error("Failed to save model checkpoint %s: %s", checkpoint_file, future.exception())
+            return
+        os.replace(tmp_file, checkpoint_file)
+        logger.info("Saved model checkpoint to [DIR: %s]", args.output_dir)
+
+    args.checkpoint_executor.submit(torch.save, state, tmp_file).add_done_callback(_finalize)
+
+
+def _to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
 
 
 def setup(args):
@@ -82,8 +109,22 @@ def setup(args):
         num_classes = 100
 
     model = VisionTransformer(config, args.img_size, zero_head=True, num_classes=num_classes)
-    model.load_from(np.load(args.pretrained_dir))
+    # Let rank 0 read the checkpoint first; the other ranks then hit the page cache
+    if args.local_rank not in [-1, 0]:
+        torch.distributed.barrier()
+    with np.load(args.pretrained_dir) as weights:
+        model.load_from(weights)
+    if args.local_rank == 0:
+        torch.distributed.barrier()
     model.to(args.device)
+    model = model.to(memory_format=torch.channels_last)
+    # Compile in place, before the DDP wrap in train(), so Dynamo sees the unwrapped
+    # module and state_dict() keys keep matching uncompiled checkpoints
+    if hasattr(torch, "compile") and args.compile:
+        if hasattr(model, "compile"):
+            model.compile(mode="max-autotune", fullgraph=False)
+        else:
+            model.forward = torch.compile(model.forward, mode="max-autotune", fullgraph=False)
     num_params = count_parameters(model)
 
     logger.info("{}".format(config))
@@ -120,32 +161,30 @@ def valid(args, model, writer, test_loader, global_step):
                           desc="Validating... (loss=X.X)",
                           bar_format="{l_bar}{r_bar}",
                           dynamic_ncols=True,
+                          mininterval=1.0,
+                          miniters=10,
                           disable=args.local_rank not in [-1, 0])
-    loss_fct = torch.nn.CrossEntropyLoss()
     for step, batch in enumerate(epoch_iterator):
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = tuple(t.to(args.device, non_blocking=True) for t in batch)
         x, y = batch
-        with torch.no_grad():
-            logits = model(x)[0]
+        x = x.to(memory_format=torch.channels_last, non_blocking=True)
+        with torch.inference_mode():
+            with torch.cuda.amp.autocast(dtype=torch.float16, enabled=args.fp16):
+                logits = model(x)[0]
+            logits = logits.float()
 
-            eval_loss = loss_fct(logits, y)
-            eval_losses.update(eval_loss.item())
+            eval_loss = F.cross_entropy(logits, y)
+            eval_losses.update(eval_loss.item(), n=y.size(0))
 
-            preds = torch.argmax(logits, dim=-1)
+            preds = logits.argmax(dim=-1)
 
-        if len(all_preds) == 0:
-            all_preds.append(preds.detach().cpu().numpy())
-            all_label.append(y.detach().cpu().numpy())
-        else:
-            all_preds[0] = np.append(
-                all_preds[0], preds.detach().cpu().numpy(), axis=0
-            )
-            all_label[0] = np.append(
-                all_label[0], y.detach().cpu().numpy(), axis=0
-            )
-        epoch_iterator.set_description("Validating... (loss=%2.5f)" % eval_losses.val)
-
-    all_preds, all_label = all_preds[0], all_label[0]
+        all_preds.append(preds)
+        all_label.append(y)
+        # refresh=False leaves redraws to tqdm's mininterval/miniters throttling
+        epoch_iterator.set_description("Validating... (loss=%2.5f)" % eval_losses.val, refresh=False)
+
+    all_preds = torch.cat(all_preds)
+    all_label = torch.cat(all_label)
     accuracy = simple_accuracy(all_preds, all_label)
 
     logger.info("\n")
@@ -179,21 +218,27 @@ def mAp(args, model, writer, test_loader, global_step):
     conf_matrix.reset()
     topacc.reset()
 
-    with torch.no_grad():
+    probs_list, y_list = [], []
+    with torch.inference_mode():
         for x2, y in test_loader:
 
-            x2 = x2.to(args.device)
-            y = y.to(args.device)
-            one_hot_y = torch.nn.functional.one_hot(y, num_classes=40)
-            one_hot_y = one_hot_y.to(args.device)
-            outputs = model(x2)[0]
-            _, preds = torch.max(outputs, 1)
-            probs = torch.nn.functional.softmax(outputs, dim=1)
-            class_acc.add(probs, one_hot_y)
-            test_map.add(probs, one_hot_y)
-            conf_matrix.add(probs, one_hot_y)
-            topacc.add(probs, y)
-            
+            x2 = x2.to(args.device, non_blocking=True)
+            x2 = x2.to(memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(args.device, non_blocking=True)
+            with torch.cuda.amp.autocast(dtype=torch.float16, enabled=args.fp16):
+                outputs = model(x2)[0]
+            probs_list.append(F.softmax(outputs.float(), dim=1))
+            y_list.append(y)
+
+    # Feed the meters once with a single device-to-host copy
+    probs = torch.cat(probs_list).cpu()
+    y = torch.cat(y_list).cpu()
+    one_hot_y = F.one_hot(y, num_classes=40)
+    class_acc.add(probs, one_hot_y)
+    test_map.add(probs, one_hot_y)
+    conf_matrix.add(probs, one_hot_y)
+    topacc.add(probs, y)
+
     logger.info('class accs are {}'.format(class_acc.value()))
     logger.info('mAp is equal to {}'.format(test_map.value()))
     logger.info('confusion matrix is {}'.format(conf_matrix.value()))
@@ -206,38 +251,36 @@ def train(args, model):
     if args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir, exist_ok=True)
         writer = SummaryWriter(log_dir=os.path.join("logs", args.name))
+        args.checkpoint_executor = ThreadPoolExecutor(max_workers=1)
 
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
 
     # Prepare dataset
     train_loader, test_loader = get_loader(args)
 
-
-  #  # Trainable Parameters
-  #   for name, param in model.named_parameters():
-  #       if 'transformer.encoder.layer.11' in name:
-  #           param.requires_grad_(True)
-  #           print(name)
-  #       elif 'transformer.encoder.layer.10' in name:
-  #           param.requires_grad_(True)
-  #           print(name)
-  #       elif 'head.weight' in name or \
-  #           'head.bias' in name:
-  #           param.requires_grad_(True)
-  #           print(name)
-  #       elif 'transformer.encoder.encoder_norm.weight' in name \
-  #               or 'transformer.encoder.encoder_norm.bias' in name:
-  #           param.requires_grad_(True)
-  #           print(name)
-  #       else:
-  #          param.requires_grad_(False)
-
+    # Trainable Parameters
+    if args.num_trainable_layers > 0:
+        num_layers = CONFIGS[args.model_type].transformer["num_layers"]
+        trainable_names = ['transformer.encoder.layer.%d.' % i
+                           for i in range(num_layers - args.num_trainable_layers, num_layers)]
+        trainable_names += ['head.', 'transformer.encoder.encoder_norm.']
+        for name, param in model.named_parameters():
+            param.requires_grad_(any(t in name for t in trainable_names))
+        logger.info("Trainable Parameter: \t%2.1fM" % count_parameters(model))
 
     # Prepare optimizer and scheduler
-    optimizer = torch.optim.SGD(model.parameters(),
-                                lr=args.learning_rate,
-                                momentum=0.9,
-                                weight_decay=args.weight_decay)
+    # Frozen parameters get no momentum buffers or weight decay
+    trainable_params = [p for p in model.parameters() if p.requires_grad]
+    # Prefer the single-kernel fused update on CUDA, else the multi-tensor foreach one
+    optimizer_kwargs = dict(lr=args.learning_rate,
+                            momentum=0.9,
+                            weight_decay=args.weight_decay,
+                            nesterov=False)
+    if args.device.type == "cuda" and 'fused' in inspect.signature(torch.optim.SGD).parameters:
+        optimizer_kwargs['fused'] = True
+    else:
+        optimizer_kwargs['foreach'] = True
+    optimizer = torch.optim.SGD(trainable_params, **optimizer_kwargs)
     # optimizer = torch.optim.Adam(model.parameters(),
     #                             lr=args.learning_rate,
     #                             # momentum=0.9,
@@ -251,15 +294,20 @@ def train(args, model):
 
     # scheduler =torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max= t_total, eta_min=0, last_epoch=-1, verbose=False)
 
-    if args.fp16:
-        model, optimizer = amp.initialize(models=model,
-                                          optimizers=optimizer,
-                                          opt_level=args.fp16_opt_level)
-        amp._amp_state.loss_scalers[0]._loss_scale = 2**20
+    if args.loss_scale > 0:
+        # Static loss scale: GradScaler requires growth_factor > 1, so never reach the growth interval
+        scaler = torch.cuda.amp.GradScaler(init_scale=args.loss_scale, growth_interval=2**30, enabled=args.fp16)
+    else:
+        scaler = torch.cuda.amp.GradScaler(init_scale=2**20, enabled=args.fp16)
 
     # Distributed training
     if args.local_rank != -1:
-        model = DDP(model, message_size=250000000, gradient_predivide_factor=get_world_size())
+        model = TorchDDP(model,
+                         device_ids=[args.local_rank],
+                         output_device=args.local_rank,
+                         bucket_cap_mb=25,
+                         gradient_as_bucket_view=True,
+                         static_graph=True)
 
     # Train!
     logger.info("***** Running training *****")
@@ -287,71 +335,93 @@ def train(args, model):
         else:
             model.load_state_dict(checkpoint)
 
-    model.zero_grad()
+    model.zero_grad(set_to_none=True)
     set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
     losses = AverageMeter()
+    # Running sum of the loss kept on device; only read back every log_every steps
+    loss_accum = torch.zeros((), device=args.device)
+    loss_count = 0
 
     mAp(args, model, writer, test_loader, global_step = -1)
 
-    # global_step, best_acc = 0, 0
-    while True:
-        model.train()
-        epoch_iterator = tqdm(train_loader,
-                              desc="Training (X / X Steps) (loss=X.X)",
-                              bar_format="{l_bar}{r_bar}",
-                              dynamic_ncols=True,
-                              disable=args.local_rank not in [-1, 0])
-        for step, batch in enumerate(epoch_iterator):
-            batch = tuple(t.to(args.device) for t in batch)
-            x, y = batch
-            loss = model(x, y)
-
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
-
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                losses.update(loss.item()*args.gradient_accumulation_steps)
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
+    # Prefer the FlashAttention / memory-efficient SDPA kernels on GPU
+    if args.device.type == "cuda" and sdpa_kernel is not None:
+        sdp_ctx = sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+    elif args.device.type == "cuda" and hasattr(torch.backends.cuda, "sdp_kernel"):
+        sdp_ctx = torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
+    else:
+        sdp_ctx = contextlib.nullcontext()
+    with sdp_ctx:
+        # global_step, best_acc = 0, 0
+        while True:
+            model.train()
+            epoch_iterator = tqdm(train_loader,
+                                  desc="Training (X / X Steps) (loss=X.X)",
+                                  bar_format="{l_bar}{r_bar}",
+                                  dynamic_ncols=True,
+                                  mininterval=1.0,
+                                  miniters=10,
+                                  disable=args.local_rank not in [-1, 0])
+            for step, batch in enumerate(epoch_iterator):
+                batch = tuple(t.to(args.device, non_blocking=True) for t in batch)
+                x, y = batch
+                x = x.to(memory_format=torch.channels_last, non_blocking=True)
+                # Only all-reduce gradients on the micro-batch that steps the optimizer
+                is_accum_step = (step + 1) % args.gradient_accumulation_steps != 0
+                sync_ctx = model.no_sync() if (args.local_rank != -1 and is_accum_step) else contextlib.nullcontext()
+                with sync_ctx:
+                    with torch.cuda.amp.autocast(dtype=torch.float16, enabled=args.fp16):
+                        loss = model(x, y)
+
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
+                    scaler.scale(loss).backward()
+                loss_accum += loss.detach()
+                loss_count += 1
+
+                if (step + 1) % args.gradient_accumulation_steps == 0:
+                    scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-                scheduler.step()
-                optimizer.step()
-                optimizer.zero_grad()
-                global_step += 1
-
-                epoch_iterator.set_description(
-                    "Training (%d / %d Steps) (loss=%2.5f)" % (global_step, t_total, losses.val)
-                )
-                if args.local_rank in [-1, 0]:
-                    writer.add_scalar("train/loss", scalar_value=losses.val, global_step=global_step)
-                    writer.add_scalar("train/lr", scalar_value=scheduler.get_last_lr()[0], global_step=global_step)
-                # save_checkpoint
-                # save_model_complete(args, model, optimizer, accuracy = None, step = global_step)
+                    scheduler.step()
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+                    global_step += 1
+
+                    if global_step % args.log_every == 0:
+                        # Average over the micro-batches actually summed, which includes any
+                        # left over from an epoch whose length is not a multiple of the accumulation
+                        losses.update((loss_accum * args.gradient_accumulation_steps / loss_count).item())
+                        loss_accum.zero_()
+                        loss_count = 0
+                        epoch_iterator.set_description(
+                            "Training (%d / %d Steps) (loss=%2.5f)" % (global_step, t_total, losses.val)
+                        )
+                        if args.local_rank in [-1, 0]:
+                            writer.add_scalar("train/loss", scalar_value=losses.val, global_step=global_step)
+                            writer.add_scalar("train/lr", scalar_value=scheduler.get_last_lr()[0], global_step=global_step)
+                    # save_checkpoint
+                    # save_model_complete(args, model, optimizer, accuracy = None, step = global_step)
                 
-                if global_step % args.eval_every == 0 and args.local_rank in [-1, 0]:
-                    accuracy = valid(args, model, writer, test_loader, global_step)
-                    # writer.add_scalar("test/acc", scalar_value=accuracy, global_step=global_step)
-                    mAp(args, model, writer, test_loader, global_step)
-
-                    if best_acc < accuracy:
-                        save_model_complete(args, model, optimizer, accuracy, global_step)
-                        best_acc = accuracy
-                    model.train()
-
-                if global_step % t_total == 0:
-                    break
-        losses.reset()
-        if global_step % t_total == 0:
-            break
+                    if global_step % args.eval_every == 0 and args.local_rank in [-1, 0]:
+                        accuracy = valid(args, model, writer, test_loader, global_step)
+                        # writer.add_scalar("test/acc", scalar_value=accuracy, global_step=global_step)
+                        mAp(args, model, writer, test_loader, global_step)
+
+                        if best_acc < accuracy:
+                            save_model_complete(args, model, optimizer, accuracy, global_step)
+                            best_acc = accuracy
+                        model.train()
+
+                    if global_step % t_total == 0:
+                        break
+            losses.reset()
+            if global_step % t_total == 0:
+                break
 
     if args.local_rank in [-1, 0]:
         writer.close()
+        args.checkpoint_executor.shutdown(wait=True)
     logger.info("Best Accuracy: \t%f" % best_acc)
     logger.info("End Training!")
 
@@ -389,16 +459,28 @@ def main():
     #                     help="Total batch size for training.")
     parser.add_argument("--eval_batch_size", default=64, type=int,
                         help="Total batch size for eval.")
+    parser.add_argument("--num_workers", default=4, type=int,
+                        help="Number of DataLoader worker processes per GPU.")
+    parser.add_argument("--in_memory", action="store_true",
+                        help="Decode the whole dataset once and keep it in memory.")
+    parser.add_argument("--prefetch_factor", default=2, type=int,
+                        help="Number of batches loaded in advance by each worker.")
     parser.add_argument("--eval_every", default=100, type=int,
                         help="Run prediction on validation set every so many steps."
                              "Will always run one evaluation at the end of training.")
 
+    parser.add_argument("--log_every", default=10, type=int,
+                        help="Read back and log the training loss every so many steps.")
+
     parser.add_argument("--learning_rate", default=3e-2, type=float,
                         help="The initial learning rate for SGD.")
     # parser.add_argument("--learning_rate", default=3e-4, type=float,
     #                     help="The initial learning rate for SGD.")
     parser.add_argument("--weight_decay", default=0, type=float,
                         help="Weight deay if we apply some.")
+    parser.add_argument("--num_trainable_layers", default=0, type=int,
+                        help="Only finetune the last so many encoder layers (plus the encoder norm and head). "
+                             "0 (default value): finetune the whole model.")
     parser.add_argument("--num_steps", default=10000, type=int,
                         help="Total number of training epochs to perform.")
     parser.add_argument("--decay_type", choices=["cosine", "linear"], default="cosine",
@@ -416,13 +498,14 @@ def main():
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
-    parser.add_argument('--fp16_opt_level', type=str, default='O2',
-                        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                             "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument('--tf32', action='store_true',
+                        help="Whether to allow TF32 matmuls and convolutions on Ampere or newer GPUs")
+    parser.add_argument('--compile', action='store_true',
+                        help="Whether to compile the model with torch.compile (PyTorch >= 2.0)")
     parser.add_argument('--loss_scale', type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
-                             "0 (default value): dynamic loss scaling.\n"
-                             "Positive power of 2: static loss scaling value.\n")
+                             "0 (default value): dynamic loss scaling starting at 2**20.\n"
+                             "Positive power of 2: static loss scaling value (only lowered on overflow).\n")
     args = parser.parse_args()
 
     # Setup CUDA, GPU & distributed training
@@ -447,6 +530,12 @@ def main():
     # Set seed
     set_seed(args)
 
+    # img_size and batch size are fixed per run, so let cuDNN pick the fastest kernels
+    torch.backends.cudnn.benchmark = True
+    if args.tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
     # Model & Tokenizer Setup
     args, model = setup(args)
 
@@ -1,15 +1,61 @@
+import copy
 import logging
 
 import torch
 
 from torchvision import transforms, datasets
-from torch.utils.data import DataLoader, RandomSampler, DistributedSampler, SequentialSampler
+from torch.utils.data import DataLoader, Dataset, RandomSampler, DistributedSampler, SequentialSampler
 from torchvision.transforms.transforms import RandomVerticalFlip
 
 
 logger = logging.getLogger(__name__)
 
 
+class InMemoryDataset(Dataset):
+    """Decodes every image of a CIFAR / ImageFolder dataset once and keeps it in memory as uint8
+
+    `resize` is applied to ImageFolder images while loading, so a fixed test-time Resize
+    stores img_size images instead of full-resolution JPEGs. CIFAR images are kept at 32x32.
+    """
+    def __init__(self, dataset, transform=None, resize=None):
+        if isinstance(dataset, datasets.CIFAR10):
+            # CIFAR100 subclasses CIFAR10; data is already a decoded NHWC uint8 array
+            self.images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+        else:
+            # ImageFolder images differ in size, so they cannot be stacked
+            self.images = []
+            for path, _ in dataset.samples:
+                img = dataset.loader(path)
+                if resize is not None:
+                    img = resize(img)
+                self.images.append(transforms.functional.pil_to_tensor(img))
+        self.targets = torch.as_tensor(dataset.targets)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        img = self.images[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index]
+
+
+def tensor_transform(transform):
+    """Same pipeline for uint8 image tensors: ToTensor becomes a dtype conversion"""
+    tensor_transforms = []
+    for t in transform.transforms:
+        if isinstance(t, transforms.ToTensor):
+            t = transforms.ConvertImageDtype(torch.float)
+        elif isinstance(t, (transforms.Resize, transforms.RandomResizedCrop)):
+            # Tensor resizing only antialiases like PIL when asked to
+            t = copy.copy(t)
+            t.antialias = True
+        tensor_transforms.append(t)
+    return transforms.Compose(tensor_transforms)
+
+
 def get_loader(args):
     if args.local_rank not in [-1, 0]:
         torch.distributed.barrier()
@@ -92,17 +138,27 @@ def get_loader(args):
     if args.local_rank == 0:
         torch.distributed.barrier()
 
+    if args.in_memory:
+        # Skip per-step decoding; random augmentation is still applied per sample
+        # Done after the download barrier so all ranks decode concurrently
+        trainset = InMemoryDataset(trainset, tensor_transform(transform_train))
+        testset = InMemoryDataset(testset, tensor_transform(transform_test),
+                                  resize=transforms.Resize((args.img_size, args.img_size))) if testset is not None else None
+        logger.info("Loaded %d train images into memory", len(trainset))
+
     train_sampler = RandomSampler(trainset) if args.local_rank == -1 else DistributedSampler(trainset)
     test_sampler = SequentialSampler(testset)
+    # Keep workers alive across epochs; prefetch_factor is only valid with workers
+    worker_kwargs = dict(num_workers=args.num_workers, pin_memory=True)
+    if args.num_workers > 0:
+        worker_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
     train_loader = DataLoader(trainset,
                               sampler=train_sampler,
                               batch_size=args.train_batch_size,
-                              num_workers=4,
-                              pin_memory=True)
+                              **worker_kwargs)
     test_loader = DataLoader(testset,
                              sampler=test_sampler,
                              batch_size=args.eval_batch_size,
-                             num_workers=4,
-                             pin_memory=True) if testset is not None else None
+                             **worker_kwargs) if testset is not None else None
 
     return train_loader, test_loader